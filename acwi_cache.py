@@ -0,0 +1,374 @@
+import os
+import re
+import time
+import pickle
+import inspect
+import shutil
+import hashlib
+import logging
+import tempfile
+from collections import OrderedDict
+
+import torch
+import torch.nn.functional as F
+
+_logger = logging.getLogger(__name__)
+
+_FINGERPRINT = re.compile(r'^[0-9a-f]{32}$')
+
+
+def _tensor_bytes(x):
+    return x.view(torch.uint8).numpy().tobytes() if x.dtype == torch.bfloat16 else x.numpy().tobytes()
+
+
+def content_hashes(x):
+    """ exact hash of every sample of a preprocessed batch (B, C, H, W) """
+    x = x.detach().contiguous().cpu()
+    meta = str((tuple(x.shape[1:]), str(x.dtype))).encode()
+    keys = []
+    for s in x:
+        h = hashlib.blake2b(meta, digest_size=16)
+        h.update(_tensor_bytes(s))
+        keys.append(h.hexdigest())
+    return keys
+
+
+def perceptual_hashes(x, hash_size=16, color_levels=8):
+    """ perceptual hash of every sample of a batch (B, C, H, W)
+
+    Per-channel average hash (one bit per cell of a hash_size x hash_size grid, set when
+    above the channel mean) plus the channel means quantized to color_levels steps over
+    the batch-independent range [-3, 3] of normalized inputs.
+    Resized or re-encoded copies usually map to the same key, but matching is exact, so
+    near-duplicates whose cells sit close to the threshold can still miss. Different images
+    with the same coarse layout and colors do collide and are served each other's results;
+    use content hashing where that is not acceptable.
+    """
+    x = x.detach().float()
+    grid = F.adaptive_avg_pool2d(x, hash_size).flatten(2)
+    mean = grid.mean(dim=2, keepdim=True)
+    bits = (grid > mean).cpu().numpy()
+    color = ((mean.squeeze(2).clamp(-3., 3.) + 3.) / 6. * (color_levels - 1)).round().to(torch.uint8).cpu().numpy()
+    meta = str((hash_size, color_levels)).encode()
+    return ['p' + hashlib.blake2b(meta + b.tobytes() + c.tobytes(), digest_size=16).hexdigest()
+            for b, c in zip(bits, color)]
+
+
+def weights_fingerprint(model):
+    """ hash of all parameters and buffers, used to namespace cache entries """
+    h = hashlib.blake2b(digest_size=16)
+    for k, v in model.state_dict().items():
+        h.update(k.encode())
+        v = v.detach().contiguous().cpu()
+        h.update(str((tuple(v.shape), str(v.dtype))).encode())
+        h.update(_tensor_bytes(v))
+    return h.hexdigest()
+
+
+def _weights_version(model):
+    # cheap token that changes on in-place updates (optimizer.step, load_state_dict) or re-assignment,
+    # but NOT on updates through .data, which have their own version counter
+    return tuple((t.data_ptr(), t._version) for t in model.state_dict(keep_vars=True).values())
+
+
+class MemoryLRU:
+    """ in-memory LRU of cpu tensors bounded by a byte budget """
+    def __init__(self, max_bytes=256 * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        v = self._entries.get(key)
+        if v is not None:
+            self._entries.move_to_end(key)
+        return v
+
+    def put(self, key, value):
+        size = value.numel() * value.element_size()
+        if size > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.nbytes -= old.numel() * old.element_size()
+        self._entries[key] = value
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            _, v = self._entries.popitem(last=False)
+            self.nbytes -= v.numel() * v.element_size()
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+
+class DiskCache:
+    """ persistent tier, one file per entry under root/acwi_cache/<weights fingerprint>/<key[-2:]>/
+
+    Only 32-hex namespace directories inside root/acwi_cache are read, counted, evicted or
+    pruned, so root may be shared with other files and other models' caches. Namespaces of
+    weights no longer in use are removed by the byte budget. Bounded by max_bytes (None for unbounded);
+    once exceeded, least recently used entries are removed down to 90% of the budget.
+    Requires torch>=1.13 for torch.load(weights_only=True).
+    """
+    subdir = 'acwi_cache'
+
+    def __init__(self, root, max_bytes=4 * 1024 ** 3):
+        if 'weights_only' not in inspect.signature(torch.load).parameters:
+            raise RuntimeError('The disk cache tier requires torch>=1.13 (torch.load weights_only)')
+        self.root = os.path.join(root, self.subdir)
+        self.max_bytes = max_bytes
+        self._index = OrderedDict()  # path -> size, least recently used first
+        self.nbytes = 0
+        self._load_index()
+
+    def _namespaces(self):
+        if not os.path.isdir(self.root):
+            return []
+        return [n for n in os.listdir(self.root)
+                if _FINGERPRINT.match(n) and os.path.isdir(os.path.join(self.root, n))]
+
+    def _load_index(self):
+        files = []
+        for name in self._namespaces():
+            for dirpath, _, filenames in os.walk(os.path.join(self.root, name)):
+                for f in filenames:
+                    if f.endswith('.pt'):
+                        path = os.path.join(dirpath, f)
+                        st = os.stat(path)
+                        files.append((st.st_mtime, path, st.st_size))
+        self._index.clear()
+        for _, path, size in sorted(files):
+            self._index[path] = size
+        self.nbytes = sum(self._index.values())
+
+    def _path(self, namespace, key):
+        return os.path.join(self.root, namespace, key[-2:], key + '.pt')
+
+    def _remove(self, path):
+        self.nbytes -= self._index.pop(path, 0)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def get(self, namespace, key):
+        path = self._path(namespace, key)
+        if not os.path.exists(path):
+            return None
+        try:
+            value = torch.load(path, map_location='cpu', weights_only=True)
+        except (RuntimeError, EOFError, ValueError, pickle.UnpicklingError) as e:
+            _logger.warning('Dropping unreadable cache entry %s: %s', path, e)
+            self._remove(path)
+            return None
+        except OSError as e:
+            _logger.warning('Could not read cache entry %s: %s', path, e)
+            return None
+        if path in self._index:
+            self._index.move_to_end(path)
+        else:
+            self._index[path] = os.path.getsize(path)
+            self.nbytes += self._index[path]
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def put(self, namespace, key, value):
+        path = self._path(namespace, key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        except OSError as e:
+            _logger.warning('Could not write cache entry %s: %s', path, e)
+            return
+        try:
+            os.close(fd)
+            torch.save(value, tmp)
+            size = os.path.getsize(tmp)
+            os.replace(tmp, path)
+        except Exception as e:
+            _logger.warning('Could not write cache entry %s: %s', path, e)
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return
+        self.nbytes += size - self._index.pop(path, 0)
+        self._index[path] = size
+        if self.max_bytes is not None and self.nbytes > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        low_water = int(self.max_bytes * 0.9)
+        while self._index and self.nbytes > low_water:
+            path = next(iter(self._index))
+            self._remove(path)
+
+    def prune(self, namespace):
+        """ drop the entries of one namespace (weights fingerprint) """
+        if not _FINGERPRINT.match(namespace):
+            return
+        path = os.path.join(self.root, namespace) + os.sep
+        for p in [p for p in self._index if p.startswith(path)]:
+            self.nbytes -= self._index.pop(p)
+        shutil.rmtree(path, ignore_errors=True)
+
+
+class CachedPredictor:
+    """ Result cache in front of a model, e.g. DeiT_trans_ACWI
+
+    Samples are keyed by an exact content hash of the preprocessed tensor (key='content')
+    or by a perceptual hash that also matches near-duplicates (key='perceptual', see
+    perceptual_hashes for its collision risk). Only unique cache misses in a batch are run
+    through the model. Entries are namespaced by a fingerprint of the weights.
+
+    In-place weight updates and load_state_dict are detected on every call. Updates through
+    .data are not; they are picked up when the fingerprint is recomputed every refresh_every
+    calls, or immediately by calling invalidate(). A fingerprint copies and hashes every weight
+    on the cpu (~350MB for DeiT-B), so keep refresh_every large or 0 and prefer invalidate().
+
+    Args:
+        model: module with forward / forward_features / forward_head
+        key (str): 'content' or 'perceptual'
+        pre_logits (bool): cache pooled pre-logit features instead of logits
+        max_bytes (int): byte budget of the in-memory LRU tier
+        disk_dir (str): directory of the persistent tier, disabled if None
+        disk_max_bytes (int): byte budget of the persistent tier, None for unbounded
+        hash_size (int): grid size of the perceptual hash
+        refresh_every (int): recompute the weights fingerprint every n calls, 0 to disable
+    """
+    def __init__(self, model, key='content', pre_logits=False, max_bytes=256 * 1024 ** 2,
+                 disk_dir=None, disk_max_bytes=4 * 1024 ** 3, hash_size=16, refresh_every=1000):
+        assert key in ('content', 'perceptual')
+        self.model = model
+        self.key = key
+        self.pre_logits = pre_logits
+        self.hash_size = hash_size
+        self.refresh_every = refresh_every
+        self.memory = MemoryLRU(max_bytes)
+        self.disk = DiskCache(disk_dir, disk_max_bytes) if disk_dir else None
+        self._version = None
+        self._calls = 0
+        self.fingerprint = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.compute_time = 0.
+        self.lookup_time = 0.
+        self.overhead_time = 0.
+
+    def invalidate(self):
+        """ recompute the weights fingerprint now, clearing the cache if the weights changed """
+        self._version = None
+        self._check_weights(force=True)
+
+    def _check_weights(self, force=False):
+        self._calls += 1
+        version = _weights_version(self.model)
+        refresh = self.refresh_every and self._calls % self.refresh_every == 0
+        if force or refresh or version != self._version:
+            fingerprint = weights_fingerprint(self.model)
+            if fingerprint != self.fingerprint:
+                if self.fingerprint is not None:
+                    _logger.info('Model weights changed, invalidating prediction cache')
+                    # only drop entries of our own previous weights, never on first use
+                    if self.disk is not None:
+                        self.disk.prune(self.fingerprint)
+                self.memory.clear()
+                self.fingerprint = fingerprint
+            self._version = version
+
+    def _hash(self, x):
+        return content_hashes(x) if self.key == 'content' else perceptual_hashes(x, self.hash_size)
+
+    def _run(self, x):
+        if self.pre_logits:
+            return self.model.forward_head(self.model.forward_features(x), pre_logits=True)
+        return self.model(x)
+
+    def __call__(self, x):
+        if self.model.training or x.shape[0] == 0:
+            # dropout / drop path make outputs non-deterministic, never cache them
+            return self._run(x)
+        with torch.no_grad():
+            return self._cached(x)
+
+    def _cached(self, x):
+        t0 = time.perf_counter()
+        self._check_weights()
+        self.overhead_time += time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        prefix = '%s-%d-' % (self.key, self.pre_logits)
+        keys = [prefix + k for k in self._hash(x)]
+        out = [None] * len(keys)
+        todo = OrderedDict()
+        for i, k in enumerate(keys):
+            if k in todo:
+                todo[k].append(i)
+                continue
+            v = self.memory.get(k)
+            if v is None and self.disk is not None:
+                v = self.disk.get(self.fingerprint, k)
+                if v is not None:
+                    self.memory.put(k, v)
+                    self.disk_hits += 1
+            elif v is not None:
+                self.memory_hits += 1
+            if v is None:
+                todo[k] = [i]
+            else:
+                out[i] = v
+        self.lookup_time += time.perf_counter() - t0
+
+        if todo:
+            t0 = time.perf_counter()
+            y = self._run(x[[idx[0] for idx in todo.values()]])
+            if x.is_cuda:
+                torch.cuda.synchronize(x.device)
+            self.compute_time += time.perf_counter() - t0
+            self.misses += len(todo)
+            for (k, idx), v in zip(todo.items(), y):
+                # repeats of a key within the batch are served from this single run
+                self.memory_hits += len(idx) - 1
+                for i in idx:
+                    out[i] = v
+                v = v.detach().cpu().clone()
+                self.memory.put(k, v)
+                if self.disk is not None:
+                    t0 = time.perf_counter()
+                    self.disk.put(self.fingerprint, k, v)
+                    self.overhead_time += time.perf_counter() - t0
+
+        device = x.device
+        return torch.stack([v.to(device) for v in out])
+
+    @property
+    def hit_rate(self):
+        total = self.memory_hits + self.disk_hits + self.misses
+        return (self.memory_hits + self.disk_hits) / total if total else 0.
+
+    @property
+    def latency_saved(self):
+        """ estimated seconds saved: hits x mean per-sample compute time, minus the time spent on
+        lookups, weight checks / fingerprints and disk writes
+        """
+        if not self.misses:
+            return 0.
+        per_sample = self.compute_time / self.misses
+        return (self.memory_hits + self.disk_hits) * per_sample - self.lookup_time - self.overhead_time
+
+    def stats(self):
+        return dict(
+            memory_hits=self.memory_hits, disk_hits=self.disk_hits, misses=self.misses,
+            hit_rate=self.hit_rate, latency_saved=self.latency_saved,
+            memory_entries=len(self.memory), memory_bytes=self.memory.nbytes)
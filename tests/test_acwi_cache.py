@@ -0,0 +1,194 @@
+import os
+import sys
+
+import pytest
+
+torch = pytest.importorskip('torch')
+import torch.nn as nn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from acwi_cache import CachedPredictor, DiskCache, MemoryLRU
+
+
+class ToyNet(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.head = nn.Linear(12, 4)
+        self.calls = 0
+
+    def forward_features(self, x):
+        self.calls += x.shape[0]
+        return x.flatten(1)
+
+    def forward_head(self, x, pre_logits: bool = False):
+        return x if pre_logits else self.head(x)
+
+    def forward(self, x):
+        return self.forward_head(self.forward_features(x))
+
+
+def _model():
+    torch.manual_seed(0)
+    return ToyNet().eval()
+
+
+def test_hit_miss_accounting():
+    model = _model()
+    predictor = CachedPredictor(model)
+    x = torch.randn(3, 3, 2, 2)
+    out = predictor(x)
+    assert torch.allclose(out, model.head(x.flatten(1)))
+    assert torch.equal(predictor(x), out)
+    assert (predictor.misses, predictor.memory_hits, predictor.disk_hits) == (3, 3, 0)
+    assert predictor.hit_rate == 0.5
+
+
+def test_duplicates_in_batch_run_once():
+    model = _model()
+    predictor = CachedPredictor(model)
+    x = torch.randn(1, 3, 2, 2).repeat(4, 1, 1, 1)
+    out = predictor(x)
+    assert out.shape == (4, 4)
+    assert model.calls == 1
+    assert (predictor.misses, predictor.memory_hits) == (1, 3)
+
+
+def test_empty_batch_and_training_bypass():
+    model = _model()
+    predictor = CachedPredictor(model)
+    assert predictor(torch.randn(0, 3, 2, 2)).shape == (0, 4)
+    model.train()
+    out = predictor(torch.randn(2, 3, 2, 2))
+    assert out.requires_grad
+    assert predictor.misses == 0
+
+
+def test_lru_eviction_under_max_bytes():
+    lru = MemoryLRU(max_bytes=2 * 4 * 4)
+    for k in 'abc':
+        lru.put(k, torch.zeros(4))
+    assert len(lru) == 2 and lru.nbytes == 32
+    assert lru.get('a') is None and lru.get('c') is not None
+
+    predictor = CachedPredictor(_model(), max_bytes=2 * 4 * 4)
+    predictor(torch.randn(3, 3, 2, 2))
+    assert len(predictor.memory) == 2
+
+
+def test_disk_hit_after_fresh_predictor(tmp_path):
+    model = _model()
+    x = torch.randn(2, 3, 2, 2)
+    out = CachedPredictor(model, disk_dir=str(tmp_path))(x)
+    predictor = CachedPredictor(model, disk_dir=str(tmp_path))
+    assert torch.equal(predictor(x), out)
+    assert (predictor.disk_hits, predictor.misses) == (2, 0)
+
+
+def test_disk_budget(tmp_path):
+    predictor = CachedPredictor(_model(), disk_dir=str(tmp_path), disk_max_bytes=1)
+    predictor(torch.randn(3, 3, 2, 2))
+    assert predictor.disk.nbytes <= 1
+
+
+def test_invalidation_after_load_state_dict(tmp_path):
+    model = _model()
+    predictor = CachedPredictor(model, disk_dir=str(tmp_path))
+    x = torch.randn(2, 3, 2, 2)
+    predictor(x)
+    old = predictor.fingerprint
+    state = {k: v + 1 for k, v in model.state_dict().items()}
+    model.load_state_dict(state)
+    out = predictor(x)
+    assert torch.allclose(out, model.head(x.flatten(1)))
+    assert predictor.fingerprint != old
+    assert predictor.misses == 4
+    assert not os.path.exists(os.path.join(str(tmp_path), 'acwi_cache', old))
+
+
+def test_invalidation_after_data_update():
+    model = _model()
+    predictor = CachedPredictor(model, refresh_every=0)
+    x = torch.randn(2, 3, 2, 2)
+    predictor(x)
+    model.head.weight.data.mul_(2)
+    predictor.invalidate()
+    assert len(predictor.memory) == 0
+    assert torch.allclose(predictor(x), model.head(x.flatten(1)))
+
+    predictor = CachedPredictor(model, refresh_every=1)
+    predictor(x)
+    model.head.bias.data.add_(1)
+    assert torch.allclose(predictor(x), model.head(x.flatten(1)))
+    assert predictor.misses == 4
+
+
+def test_perceptual_keeps_color():
+    predictor = CachedPredictor(_model(), key='perceptual', hash_size=2)
+    x = torch.zeros(2, 3, 2, 2)
+    x[0, 0] = 1.
+    x[1, 2] = 1.
+    predictor(x)
+    assert predictor.misses == 2
+
+
+def test_disk_leaves_foreign_files_alone(tmp_path):
+    runs = tmp_path / 'runs' / 'exp1'
+    runs.mkdir(parents=True)
+    (runs / 'best.pt').write_bytes(b'0' * 40000)
+    (tmp_path / 'best.pt').write_bytes(b'0' * 40000)
+    other = tmp_path / 'acwi_cache' / ('0' * 32) / '00'
+    other.mkdir(parents=True)
+    (other / 'entry.pt').write_bytes(b'0' * 10)
+
+    model = _model()
+    predictor = CachedPredictor(model, disk_dir=str(tmp_path), disk_max_bytes=40000)
+    x = torch.randn(2, 3, 2, 2)
+    predictor(x)
+    assert predictor.disk.nbytes < 40000
+    with torch.no_grad():
+        model.head.weight.add_(1)
+    predictor(x)
+    assert (runs / 'best.pt').exists()
+    assert (tmp_path / 'best.pt').exists()
+    assert (other / 'entry.pt').exists()
+
+
+def test_disk_shards_on_hash(tmp_path):
+    predictor = CachedPredictor(_model(), disk_dir=str(tmp_path))
+    predictor(torch.randn(8, 3, 2, 2))
+    files = list((tmp_path / 'acwi_cache' / predictor.fingerprint).glob('*/*.pt'))
+    assert len(files) == 8
+    assert all(f.parent.name == f.stem[-2:] for f in files)
+
+
+def test_disk_evicts_to_low_water(tmp_path):
+    disk = DiskCache(str(tmp_path), max_bytes=None)
+    disk.put('0' * 32, 'aa', torch.zeros(4))
+    size = disk.nbytes
+    disk.max_bytes = 10 * size
+    for i in range(1, 11):
+        disk.put('0' * 32, '%02x' % i, torch.zeros(4))
+    assert disk.nbytes <= 0.9 * disk.max_bytes
+    assert disk.get('0' * 32, 'aa') is None
+    assert disk.get('0' * 32, '0a') is not None
+
+
+def test_disk_put_failure_cleans_up(tmp_path, monkeypatch):
+    def fail(*args, **kwargs):
+        raise OSError('disk full')
+    monkeypatch.setattr(torch, 'save', fail)
+    predictor = CachedPredictor(_model(), disk_dir=str(tmp_path))
+    assert predictor(torch.randn(2, 3, 2, 2)).shape == (2, 4)
+    assert not list(tmp_path.rglob('*.tmp'))
+    assert predictor.disk.nbytes == 0
+
+
+def test_latency_saved_counts_overhead():
+    predictor = CachedPredictor(_model())
+    x = torch.randn(2, 3, 2, 2)
+    predictor(x)
+    predictor(x)
+    assert predictor.overhead_time > 0
+    per_sample = predictor.compute_time / predictor.misses
+    assert predictor.latency_saved == pytest.approx(
+        2 * per_sample - predictor.lookup_time - predictor.overhead_time)